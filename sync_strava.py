@@ -14,9 +14,12 @@ sync_strava.py  (v2)
 Run:  python sync_strava.py
 """
 
-import csv, json, os, sys, io, urllib.request, urllib.parse, subprocess
+import csv, json, os, sys, io, time, http.client, urllib.parse, subprocess, threading, statistics
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta, date
+from array import array
 from collections import defaultdict
+from functools import lru_cache
 
 REPO_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -26,8 +29,12 @@ TARGET_SECS    = 9300                 # 2:35:00
 TARGET_DIST_M  = 42195
 HM_PB_SECS     = 4380                 # 1:13:00
 HM_DIST_M      = 21097.5
+RIEGEL_EXP     = 1.06                 # Riegel fatigue exponent
+PAGE_SIZE      = 200                  # Strava per_page maximum
+PAGE_WORKERS   = 8                    # max concurrent speculative page fetches
 
 # -- .env loader --------------------------------------------------------------
+@lru_cache(maxsize=1)
 def load_env(path=".env"):
     env = {}
     try:
@@ -35,26 +42,103 @@ def load_env(path=".env"):
             for line in f:
                 line = line.strip()
                 if line and not line.startswith("#") and "=" in line:
-                    k, v = line.split("=", 1)
-                    env[k.strip()] = v.strip()
+                    k, _, v = line.partition("=")
+                    v = v.strip()
+                    if len(v) >= 2 and v[0] == v[-1] and v[0] in "\"'":
+                        v = v[1:-1]   # KEY="value" / KEY='value'
+                    env[k.strip()] = v
     except FileNotFoundError:
         print(f"ERROR: {path} not found.")
         sys.exit(1)
     return env
 
+# -- HTTP session -------------------------------------------------------------
+class StravaSession:
+    """
+    Keep-alive HTTPS connections to www.strava.com, reused for the token
+    refresh and every activities page (urlopen paid a fresh TCP+TLS handshake
+    per call). http.client connections are not thread-safe, so each thread
+    gets its own. Retries 5xx and dropped connections with backoff; 429 is
+    returned at once, as no short backoff outlasts Strava's 15-minute quota.
+    A request given an `abort` Event stops retrying as soon as it is set and
+    hands back its last response (or error).
+    """
+    RETRY_STATUS = {500, 502, 503, 504}
+
+    def __init__(self, host="www.strava.com", retries=3, backoff=0.5, timeout=30):
+        self.host, self.retries, self.backoff, self.timeout = host, retries, backoff, timeout
+        self._local = threading.local()
+        self._conns = []
+        self._lock  = threading.Lock()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = http.client.HTTPSConnection(self.host, timeout=self.timeout)
+            self._local.conn = conn
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def _drop(self):
+        conn = self._local.conn
+        conn.close()
+        self._local.conn = None
+        with self._lock:
+            self._conns.remove(conn)
+
+    def _backoff(self, attempt, abort):
+        """Sleep before the next retry; True if `abort` was set instead."""
+        delay = self.backoff * 2 ** attempt
+        if abort is None:
+            time.sleep(delay)
+            return False
+        return abort.wait(delay)
+
+    def _request(self, method, path, body=None, headers=None, abort=None):
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            conn = self._conn()
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.HTTPException, OSError):
+                self._drop()
+                if last or self._backoff(attempt, abort):
+                    raise
+                continue
+            if resp.will_close:
+                self._drop()
+            if (resp.status in self.RETRY_STATUS and not last
+                    and not self._backoff(attempt, abort)):
+                continue
+            return resp.status, data
+
+    def get(self, path, params=None, headers=None, abort=None):
+        if params:
+            path = f"{path}?{urllib.parse.urlencode(params)}"
+        return self._request("GET", path, headers=headers, abort=abort)
+
+    def post(self, path, data, headers=None):
+        headers = {"Content-Type": "application/x-www-form-urlencoded", **(headers or {})}
+        return self._request("POST", path, body=urllib.parse.urlencode(data), headers=headers)
+
+    def close(self):
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
+
 # -- OAuth --------------------------------------------------------------------
-def get_access_token(env):
-    data = urllib.parse.urlencode({
+def get_access_token(env, session):
+    _, body = session.post("/oauth/token", {
         "client_id":     env["STRAVA_CLIENT_ID"],
         "client_secret": env["STRAVA_CLIENT_SECRET"],
         "refresh_token": env["STRAVA_REFRESH_TOKEN"],
         "grant_type":    "refresh_token",
-    }).encode()
-    req = urllib.request.Request(
-        "https://www.strava.com/oauth/token", data=data, method="POST"
-    )
-    with urllib.request.urlopen(req) as resp:
-        payload = json.loads(resp.read())
+    })
+    payload = json.loads(body)
     token = payload.get("access_token")
     if not token:
         print("ERROR obtaining access token:", payload)
@@ -63,27 +147,58 @@ def get_access_token(env):
     return token
 
 # -- Strava API fetch ---------------------------------------------------------
-def fetch_api_runs(token, after_dt):
+def fetch_api_runs(token, after_dt, session):
+    """
+    Page 1 is fetched alone; while pages keep coming back full, the next
+    ones are requested concurrently in a window that starts at 2 and doubles
+    up to PAGE_WORKERS, consumed in order until a short page arrives. The
+    small first window keeps wasted calls against the rate limit low.
+    Requests past the short page are already in flight and are waited for,
+    but once it arrives they stop retrying, so a 5xx there cannot hold up
+    a finished fetch.
+    """
     after_ts = int(after_dt.timestamp())
-    activities, page = [], 1
-    while True:
-        params = urllib.parse.urlencode(
-            {"after": after_ts, "per_page": 200, "page": page}
-        )
-        req = urllib.request.Request(
-            f"https://www.strava.com/api/v3/athlete/activities?{params}",
+    done     = threading.Event()   # set once the last page has been consumed
+
+    def get_page(page):
+        # Runs on worker threads: hand back (status, body) and leave reporting
+        # to take(), so a failed page past the end of the data is never fatal.
+        return session.get(
+            "/api/v3/athlete/activities",
+            params={"after": after_ts, "per_page": PAGE_SIZE, "page": page},
             headers={"Authorization": f"Bearer {token}"},
+            abort=done,
         )
-        with urllib.request.urlopen(req) as resp:
-            batch = json.loads(resp.read())
-        if not batch:
-            break
+
+    activities = []
+
+    def take(page, resp):
+        status, body = resp
+        if status != 200:
+            print(f"ERROR fetching activities page {page} (HTTP {status}):", body[:200])
+            sys.exit(1)
+        batch = json.loads(body)
         runs = [a for a in batch if a.get("type") == "Run"]
         activities.extend(runs)
-        print(f"    Page {page}: {len(batch)} activities, {len(runs)} runs")
-        if len(batch) < 200:
-            break
-        page += 1
+        if batch:
+            print(f"    Page {page}: {len(batch)} activities, {len(runs)} runs")
+        return len(batch) == PAGE_SIZE   # a short page is the last one
+
+    if not take(1, get_page(1)):
+        return activities
+
+    page, window = 2, 2
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as pool:
+        more = True
+        while more:
+            futures = [pool.submit(get_page, p) for p in range(page, page + window)]
+            for i, fut in enumerate(futures):
+                if not take(page + i, fut.result()):
+                    more = False
+                    done.set()
+                    break
+            page  += window
+            window = min(window * 2, PAGE_WORKERS)
     return activities
 
 def norm_api(a):
@@ -97,24 +212,36 @@ def norm_api(a):
     }
 
 # -- Parse activities.csv (Strava bulk export) --------------------------------
+MONTHS = {m: i for i, m in enumerate(
+    ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+     "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"], 1)}
+
+def export_date(s):
+    """'Nov 2, 2025, 5:43:21 PM' -> '2025-11-02' (only the date is used)."""
+    md, year, _ = s.split(",", 2)
+    mon, day    = md.split()
+    return date(int(year), MONTHS[mon], int(day)).isoformat()
+
 def parse_export(path="activities.csv"):
-    rows = []
+    """Returns None if the export is missing (main() reports it; no printing
+    here because this runs on a background thread)."""
     if not os.path.exists(path):
-        print(f"  {path} not found, skipping.")
-        return rows
+        return None
+    rows = []
     with open(path, newline="", encoding="utf-8") as f:
         reader = csv.reader(f)
         next(reader)
         for row in reader:
-            if len(row) < 32 or row[3] != "Run":
+            # Blank distance (manual/indoor entries) is the usual bad row:
+            # reject it before the try so it never raises.
+            if len(row) < 32 or row[3] != "Run" or not row[6]:
                 continue
             try:
-                dt   = datetime.strptime(row[1].strip(), "%b %d, %Y, %I:%M:%S %p")
-                date_str = dt.strftime("%Y-%m-%d")
+                date_str = export_date(row[1])
                 dist = round(float(row[6]), 2)
                 secs = int(float(row[16])) if row[16] else 0
                 hr   = float(row[31]) if row[31] else ""
-            except Exception:
+            except (ValueError, KeyError, OverflowError):
                 continue
             rows.append({
                 "activity_id": row[0].strip(),
@@ -137,6 +264,11 @@ def merge(export_rows, api_rows):
     for r in export_rows:
         master[r["activity_id"]] = r.copy()
 
+    # (date, distance rounded to 0.1km) -> first row with that key
+    by_datekm = {}
+    for v in master.values():
+        by_datekm.setdefault((v["date"], round(v["distance_km"], 1)), v)
+
     for r in api_rows:
         if r["activity_id"] in master:
             # Update HR from API if we now have it
@@ -144,17 +276,13 @@ def merge(export_rows, api_rows):
                 master[r["activity_id"]]["avg_hr"] = r["avg_hr"]
         else:
             # Fallback: deduplicate by (date, distance rounded to 0.1km)
-            dup_key = (r["date"], round(r["distance_km"], 1))
-            existing = next(
-                (v for v in master.values()
-                 if (v["date"], round(v["distance_km"], 1)) == dup_key),
-                None,
-            )
+            dup_key  = (r["date"], round(r["distance_km"], 1))
+            existing = by_datekm.get(dup_key)
             if existing:
                 if r["avg_hr"]:
                     existing["avg_hr"] = r["avg_hr"]
             else:
-                master[r["activity_id"]] = r.copy()
+                master[r["activity_id"]] = by_datekm[dup_key] = r.copy()
 
     return sorted(master.values(), key=lambda x: x["date"])
 
@@ -165,49 +293,54 @@ def fmt_time(secs):
     m, s   = divmod(rem, 60)
     return f"{h}:{m:02d}:{s:02d}" if h else f"{m}:{s:02d}"
 
+_PLAN_START_ORD = PLAN_START.toordinal()
+
+@lru_cache(maxsize=512)
 def plan_week(date_str):
-    d    = datetime.strptime(date_str, "%Y-%m-%d").date()
-    days = (d - PLAN_START).days
+    # Fixed YYYY-MM-DD, so fromisoformat (far cheaper than strptime)
+    days = date.fromisoformat(date_str).toordinal() - _PLAN_START_ORD
     if days < 0:
         return None
     w = days // 7 + 1
     return w if 1 <= w <= 18 else None
 
 def riegel(t1_secs, d1_m, d2_m=TARGET_DIST_M):
-    return t1_secs * (d2_m / d1_m) ** 1.06
+    return t1_secs * (d2_m / d1_m) ** RIEGEL_EXP
 
 # -- Aerobic Efficiency Analysis ----------------------------------------------
-def analyse(rows):
-    # Only runs with HR data and ?5km
-    hr_runs = [
-        r for r in rows
-        if r["avg_hr"] and r["moving_secs"] > 0 and r["distance_km"] >= 5
-    ]
-
-    # Group by plan week; calculate AE per run
-    by_week = defaultdict(list)
-    for r in hr_runs:
-        w = plan_week(r["date"])
-        if not w:
-            continue
-        speed = r["distance_km"] * 1000 / r["moving_secs"]   # m/s
-        ae    = speed / float(r["avg_hr"]) * 1000             # m/s / bpm ? 1000
-        by_week[w].append({
-            "date":     r["date"],
-            "speed":    speed,
-            "hr":       float(r["avg_hr"]),
-            "ae":       ae,
-            "dist_km":  r["distance_km"],
-        })
-
+def analyse(week_groups):
+    # One pass per plan-week group over runs with HR data and ?5km: track the
+    # highest avg HR (runs outside the plan, key None, only count towards
+    # this) and keep four running sums per week. Speed and HR are also kept
+    # as packed double columns (no per-value float objects) for the regression.
     wk_ae = {}
-    for w, runs in sorted(by_week.items()):
-        wk_ae[w] = {
-            "ae":            round(sum(r["ae"] for r in runs) / len(runs), 4),
-            "avg_hr":        round(sum(r["hr"] for r in runs) / len(runs), 1),
-            "avg_pace_minkm": round(sum(1000/r["speed"]/60 for r in runs)/len(runs), 2),
-            "n":             len(runs),
-        }
+    speeds, hrs = array("d"), array("d")
+    max_avg_hr  = None
+    for w in sorted(week_groups, key=lambda k: k or 0):
+        ae_sum = hr_sum = pace_sum = 0.0
+        n = 0
+        for r in week_groups[w]:
+            if not (r["avg_hr"] and r["moving_secs"] > 0 and r["distance_km"] >= 5):
+                continue
+            hr = float(r["avg_hr"])
+            if max_avg_hr is None or hr > max_avg_hr:
+                max_avg_hr = hr
+            if w is None:
+                continue
+            speed = r["distance_km"] * 1000 / r["moving_secs"]   # m/s
+            ae_sum   += speed / hr * 1000                         # m/s / bpm ? 1000
+            hr_sum   += hr
+            pace_sum += 1000 / speed / 60
+            n        += 1
+            speeds.append(speed)
+            hrs.append(hr)
+        if n:
+            wk_ae[w] = {
+                "ae":            round(ae_sum / n, 4),
+                "avg_hr":        round(hr_sum / n, 1),
+                "avg_pace_minkm": round(pace_sum / n, 2),
+                "n":             n,
+            }
 
     # AE trend: compare first half of weeks vs second half
     wks = sorted(wk_ae)
@@ -223,23 +356,19 @@ def analyse(rows):
                        else "stable")
 
     # Linear regression of HR vs speed to predict HR at marathon pace
-    all_pts   = [r for runs in by_week.values() for r in runs]
     hr_at_mp  = None
     mp_speed  = TARGET_DIST_M / TARGET_SECS  # ? 4.537 m/s
-    if len(all_pts) >= 3:
-        n      = len(all_pts)
-        sx     = sum(r["speed"] for r in all_pts)
-        sy     = sum(r["hr"]    for r in all_pts)
-        sxy    = sum(r["speed"] * r["hr"] for r in all_pts)
-        sx2    = sum(r["speed"] ** 2      for r in all_pts)
-        denom  = n * sx2 - sx * sx
-        if denom:
-            a       = (n * sxy - sx * sy) / denom
-            b       = (sy - a * sx) / n
+    if len(speeds) >= 3:
+        try:
+            a, b = statistics.linear_regression(speeds, hrs)
+        except statistics.StatisticsError:   # every run at the same speed
+            pass
+        else:
             hr_at_mp = round(a * mp_speed + b, 1)
 
     # Red zone = 90 % of estimated true max HR
-    max_avg_hr  = max((float(r["avg_hr"]) for r in hr_runs), default=175)
+    if max_avg_hr is None:
+        max_avg_hr = 175
     est_max_hr  = max_avg_hr * 1.12   # avg HR typically ~88% of max
     red_zone_hr = round(est_max_hr * 0.90, 1)
     hr_buffer   = round(red_zone_hr - hr_at_mp, 1) if hr_at_mp else None
@@ -288,7 +417,7 @@ def fmt_pace(speed_ms):
     return f"{m}:{s:02d}/km"
 
 # -- Build training_status.json -----------------------------------------------
-def build_status(pred_secs, analysis, rows):
+def build_status(pred_secs, analysis, week_groups):
     delta = TARGET_SECS - pred_secs
     ph    = pred_secs // 3600
     pm    = (pred_secs % 3600) // 60
@@ -309,7 +438,7 @@ def build_status(pred_secs, analysis, rows):
         label  = f"NEEDS WORK \u2014 {pred_str} PROJECTED"
 
     # Week 9 specific breakdown
-    wk9_runs = [r for r in rows if plan_week(r["date"]) == 9]
+    wk9_runs = week_groups.get(9, [])
     wk9_km   = round(sum(r["distance_km"] for r in wk9_runs), 1)
 
     ae_wk = analysis["by_week"].get(analysis["current_week"])
@@ -338,13 +467,12 @@ def build_status(pred_secs, analysis, rows):
     }
 
 # -- Week 9 performance audit (printed to console) ---------------------------
-def week9_audit(rows, analysis):
+def week9_audit(week_groups, analysis):
     print()
     print("=" * 60)
     print("WEEK 9 PERFORMANCE AUDIT")
     print("=" * 60)
-    wk9 = [r for r in rows if plan_week(r["date"]) == 9]
-    for r in sorted(wk9, key=lambda x: x["date"]):
+    for r in week_groups.get(9, []):   # master is already date-sorted
         if r["moving_secs"] == 0:
             continue
         spd  = r["distance_km"] * 1000 / r["moving_secs"]
@@ -388,85 +516,109 @@ def week9_audit(rows, analysis):
 # -- Main ---------------------------------------------------------------------
 def main():
     print("== Strava Sync ==========================================")
-    env   = load_env()
-    token = get_access_token(env)
+    bg = ThreadPoolExecutor(max_workers=1)   # local work overlapped with I/O waits
+
+    # Parse the bulk export off-thread while the API calls wait on the network
+    export_job = bg.submit(parse_export, "activities.csv")
+
+    env     = load_env()
+    session = StravaSession()
+    token   = get_access_token(env, session)
 
     # Fetch all runs from Nov 1 2025 (covers full training block)
     after = datetime(2025, 11, 1, tzinfo=timezone.utc)
     print(f"  Fetching runs from {after.strftime('%b %d, %Y')}...")
-    api_rows = [norm_api(a) for a in fetch_api_runs(token, after)]
+    api_rows = [norm_api(a) for a in fetch_api_runs(token, after, session)]
+    session.close()
     print(f"  API: {len(api_rows)} runs fetched")
 
-    # Parse bulk export
-    export_rows = parse_export("activities.csv")
+    export_rows = export_job.result()
+    if export_rows is None:
+        print("  activities.csv not found, skipping.")
+        export_rows = []
     print(f"  Export: {len(export_rows)} runs parsed")
 
     # Merge
     master = merge(export_rows, api_rows)
     print(f"  Master: {len(master)} unique runs")
+    week_groups = defaultdict(list)   # plan week (None = off-plan) -> rows
+    for r in master:
+        week_groups[plan_week(r["date"])].append(r)
 
     # Write master_activities.csv
     with open("master_activities.csv", "w", newline="", encoding="utf-8") as f:
         w = csv.writer(f)
         w.writerow(["Date", "Name", "Distance_km", "Moving_Time", "Avg_HR"])
-        for r in master:
-            w.writerow([
-                r["date"],
-                r["name"],
-                r["distance_km"],
-                fmt_time(r["moving_secs"]) if r["moving_secs"] else "",
-                r["avg_hr"],
-            ])
+        w.writerows([
+            r["date"],
+            r["name"],
+            r["distance_km"],
+            fmt_time(r["moving_secs"]) if r["moving_secs"] else "",
+            r["avg_hr"],
+        ] for r in master)
     print(f"  Wrote master_activities.csv ({len(master)} rows)")
 
     # Analyse
     print()
     print("== Analysis =============================================")
-    analysis  = analyse(master)
+    analysis  = analyse(week_groups)
     pred_secs, basis = predict(master, analysis)
-    status    = build_status(pred_secs, analysis, master)
+    status    = build_status(pred_secs, analysis, week_groups)
 
     # Write training_status.json
     with open("training_status.json", "w", encoding="utf-8") as f:
-        json.dump(status, f, indent=2)
+        f.write(json.dumps(status, indent=2))
     print(f"  Wrote training_status.json -- {status['label']}")
 
-    # Print Week 9 audit to console
-    week9_audit(master, analysis)
-
     # Write timestamp file
     now_str = datetime.now().strftime("%d %b %Y at %H:%M")
     with open("last_synced.txt", "w", encoding="utf-8") as f:
         f.write(now_str)
-    print(f"\n  Last synced: {now_str}")
+    print(f"  Last synced: {now_str}")
 
-    # Git push updated data files
-    git_push(now_str)
+    # All data files are written: push them while the audit prints. git_push
+    # returns its result line so it cannot interleave with the audit output.
+    git_job = bg.submit(git_push, now_str)
+
+    # Print Week 9 audit to console
+    week9_audit(week_groups, analysis)
+
+    print()
+    print(git_job.result())
+    bg.shutdown()
 
 # ── Git auto-push ─────────────────────────────────────────────────────────────
 def git_push(timestamp):
     files = ["training_status.json", "master_activities.csv", "last_synced.txt"]
     try:
-        subprocess.run(
-            ["git", "add"] + files,
-            cwd=REPO_DIR, check=True, capture_output=True, timeout=30
-        )
+        # One cheap fork decides whether commit/push are needed at all
+        changed = subprocess.run(
+            ["git", "status", "--porcelain", "--"] + files,
+            cwd=REPO_DIR, check=True, capture_output=True, text=True, timeout=10
+        ).stdout.splitlines()
+        if not changed:
+            return "  Git: clean"
+        # Tracked files can be committed by path directly; only new ones need add
+        if any(line.startswith("??") for line in changed):
+            subprocess.run(
+                ["git", "add"] + files,
+                cwd=REPO_DIR, check=True, capture_output=True, timeout=30
+            )
         result = subprocess.run(
-            ["git", "commit", "-m", f"Auto-sync {timestamp}"],
+            ["git", "commit", "-m", f"Auto-sync {timestamp}", "--"] + files,
             cwd=REPO_DIR, capture_output=True, timeout=30
         )
         if result.returncode != 0:
-            print("  Git: nothing new to commit")
-            return
+            return "  Git: nothing new to commit"
         subprocess.run(
             ["git", "push", "origin", "master"],
             cwd=REPO_DIR, check=True, capture_output=True, timeout=60
         )
-        print("  Git push complete")
+        return "  Git push complete"
     except subprocess.TimeoutExpired:
-        print("  Git push timed out")
+        return "  Git push timed out"
     except Exception as e:
-        print(f"  Git push failed: {e}")
+        return f"  Git push failed: {e}"
 
 if __name__ == "__main__":
     main()